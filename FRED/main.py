@@ -1,4 +1,10 @@
 import subprocess, os, signal
+import re
+import math
+import mmap
+import functools
+import zlib
+import concurrent.futures
 import pyprob
 from pyprob import RemoteModel
 import numpy as np
@@ -10,6 +16,12 @@ import json
 import zipfile
 import tempfile
 
+# orjson is optional but roughly 10x faster than the stdlib encoder.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 FRED_HOME = os.environ['FRED_HOME']
 model_executable = f'{FRED_HOME}/bin/FRED'
 HOME = os.environ['HOME']
@@ -17,6 +29,8 @@ USER = os.environ['USER']
 default_params = None
 fips_dict = {'jefferson': 42065,
              'allegheny': 42003}
+# Log-space thresholds for the importance-weight sanity check in run().
+log_0_2, log_0_5, log_0_8 = math.log(0.2), math.log(0.5), math.log(0.8)
 
 # Use sacred for command line interface + hyperparams
 ex = Experiment()
@@ -44,18 +58,24 @@ def my_config():
     constraint_threshold = 0.1
 
 
+# Matches 'name = value' lines, skipping comments and blank lines. Kept as a
+# bytes pattern so it can run directly over a memory-mapped file.
+_PARAM_RE = re.compile(rb'^\s*([^#=\s][^=]*?)\s*=\s*(.*?)\s*$', re.M)
+
+@functools.lru_cache(maxsize=None)
+def _read_param_file_cached(path, mtime):
+    # mmap the file so the regex engine walks the page cache directly,
+    # with no intermediate Python string for the file contents.
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return {name.decode(): value.decode() for name, value in _PARAM_RE.findall(mm)}
+
 def read_param_file(path):
-    with open(path, 'r') as f:
-        param_lines = f.readlines()
-    param_lines = map(lambda x: x.strip(), param_lines)
-    param_lines = list(filter(lambda x: not(x.startswith('#') or x == ''), param_lines))
-    params_dict = {}
-    for param_line in param_lines:
-        parts = param_line.split('=')
-        name = parts[0].strip()
-        value = parts[1].strip()
-        params_dict[name] = value
-    return params_dict
+    # Cache on (path, mtime) so repeated reads of the same defaults file
+    # (up to 3 per trace via dump_parameter_file) skip disk and parsing.
+    return _read_param_file_cached(path, os.path.getmtime(path)).copy()
 
 def get_default_params():
     global default_params
@@ -70,13 +90,37 @@ def get_default_params():
     default_params = params.copy()
     return params
 
-def dump_parameter_file(path='', args=None, sampled_parameters={}):
-    params = get_default_params()
-    params.update(read_param_file(args.params))
+def batch_variable_values(variables):
+    # One device->host transfer per dtype instead of an .item() sync per
+    # variable (each .item() stalls on the GPU when latents live there).
+    groups = {}
+    for name, value in variables.items():
+        groups.setdefault(value.dtype, []).append((name, value))
+    values = {}
+    for group in groups.values():
+        batched = torch.stack([value.reshape(()) for _, value in group]).cpu().tolist()
+        values.update(zip((name for name, _ in group), batched))
+    return values
+
+
+def dump_parameter_file(path='', base_params=None, sampled_parameters={}):
+    params = base_params.copy()
     params.update(sampled_parameters)
+    write_param_file(path, params)
+
+
+def dump_json(path, obj):
+    if orjson is not None:
+        Path(path).write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(path, 'w') as fp:
+            json.dump(obj, fp, indent=4, separators=(',', ': '))
+
+
+def write_param_file(path, params):
+    # One write call instead of one per parameter.
     with open(path, 'w') as f:
-        for param, value in params.items():
-            f.write(f'{param} = {value}\n')
+        f.write(''.join(f'{param} = {value}\n' for param, value in params.items()))
 
 
 def init(config, seed):
@@ -112,34 +156,67 @@ def init(config, seed):
             args.days = int(get_default_params()['days'])
     
     args.params = os.path.join(args.out_dir, 'params_generated')
-    with open(args.params, 'w') as f:
-        for param, value in base_params.items():
-            f.write(f'{param} = {value}\n')
+    write_param_file(args.params, base_params)
 
-    with open(os.path.join(args.out_dir, 'config.json'), 'w') as fp:
-        json.dump(args.__dict__, fp,
-                  indent=4, separators=(',', ': '))
+    dump_json(os.path.join(args.out_dir, 'config.json'), args.__dict__)
     return args
 
 
+def compress_file(file_path, arcname):
+    # Deflate a single file in a worker process and hand back everything
+    # needed to append it to the archive without recompressing.
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    compressor = zlib.compressobj(3, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    chunks = []
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    data = b''.join(chunks)
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+
+def append_precompressed(zip_f, zinfo, data):
+    # ZipFile has no public API for adding an already-deflated member, so
+    # write the local header + payload and register the entry ourselves.
+    zinfo.header_offset = zip_f.fp.tell()
+    zip_f.fp.write(zinfo.FileHeader(False))
+    zip_f.fp.write(data)
+    zip_f.filelist.append(zinfo)
+    zip_f.NameToInfo[zinfo.filename] = zinfo
+    zip_f.start_dir = zip_f.fp.tell()
+
+
 def zipdir(path, dir_path):
-    pwd = os.getcwd()
-    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_BZIP2) as zip_f:
-        os.chdir(dir_path)
-        for root, dirs, files in os.walk('.'):
-            for cur_file in files:
-                zip_f.write(os.path.join(root, cur_file))
-    os.chdir(pwd)
+    dir_path = Path(dir_path)
+    files = [cur_file for cur_file in dir_path.rglob('*') if cur_file.is_file()]
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=3) as zip_f:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            jobs = [executor.submit(compress_file, str(cur_file), str(cur_file.relative_to(dir_path)))
+                    for cur_file in files]
+            for job in jobs:
+                append_precompressed(zip_f, *job.result())
 
 
 def run(args):
     def model_dispatcher(trace_idx, server_address):
-        arguments = f'{args.params} {trace_idx} {args.out_dir}'
+        argv = [model_executable, server_address, args.params, str(trace_idx), args.out_dir]
         if args.dump_simulator_log:
-            return subprocess.Popen(f'{model_executable} {server_address} {arguments} 2>&1 > {args.out_dir}/LOG{trace_idx} &', shell=True, preexec_fn=os.setsid)
+            with open(f'{args.out_dir}/LOG{trace_idx}', 'wb') as log_f:
+                return subprocess.Popen(argv, stdout=log_f, stderr=subprocess.STDOUT, start_new_session=True)
         else:
-            return subprocess.Popen(f'{model_executable} {server_address} {arguments} 2>&1 &', shell=True, preexec_fn=os.setsid)
+            return subprocess.Popen(argv, start_new_session=True)
 
+    zip_job = None
+    zip_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
     try:
         model = RemoteModel(random_server_address=True,
                             model_dispatcher=model_dispatcher,
@@ -147,26 +224,40 @@ def run(args):
                             kill_on_zero_likelihood=args.kill_on_zero_likelihood)
         traces = model.posterior(num_traces=args.num_traces, inference_engine=pyprob.InferenceEngine.IMPORTANCE_SAMPLING,
                                  observe={f'obs_{i}': args.constraint_threshold for i in range(args.days)})
+        # The defaults and generated params are the same for every trace,
+        # so merge them once rather than once per trace.
+        base_params = get_default_params()
+        base_params.update(read_param_file(args.params))
         trace_weights = {}
         for idx, trace in enumerate(traces):
             # Convert the latent variables that are converted to integer on C++ code.
             trace.named_variables['shelter_in_place_duration_mean'].value = trace.named_variables['shelter_in_place_duration_mean'].value.int()
             
-            dump_parameter_file(sampled_parameters={name : variable.value.item() for name, variable in trace.named_variables.items() if not variable.observed},
-                                path=os.path.join(args.out_dir, f'params{idx}'), args=args)
-            weight = np.exp(trace.log_importance_weight)
-            print(f'likelihood {idx}: {weight}')
-            assert weight < 0.2 or weight > 0.8
-            trace_weights[idx] = int(weight > 0.5)
+            sampled_parameters = batch_variable_values({name : variable.value for name, variable in trace.named_variables.items() if not variable.observed})
+            dump_parameter_file(sampled_parameters=sampled_parameters,
+                                path=os.path.join(args.out_dir, f'params{idx}'), base_params=base_params)
+            # Compare in log-space: no exp underflow for very negative
+            # log-weights and no per-trace ufunc dispatch.
+            log_weight = trace.log_importance_weight
+            print(f'log-likelihood {idx}: {log_weight}')
+            assert log_weight < log_0_2 or log_weight > log_0_8
+            trace_weights[idx] = int(log_weight > log_0_5)
 
-        print(f'Average success rate: {np.mean(list(trace_weights.keys()))}')
+        # Average the 0/1 weights (the values) -- averaging the keys would
+        # just give the mean trace index.
+        success = np.fromiter(trace_weights.values(), dtype=np.int8, count=len(trace_weights))
+        print(f'Average success rate: {success.mean()}')
 
         # Save the trace weights
-        with open(os.path.join(args.out_dir, 'weights.json'), 'w') as fp:
-            json.dump(trace_weights, fp,
-                      indent=4, separators=(',', ': '))
+        dump_json(os.path.join(args.out_dir, 'weights.json'), trace_weights)
         # Save the traces to file
         traces.copy(file_name=os.path.join(args.out_dir, f'traces'))
+
+        if args.compressed_file_path is not None:
+            # Kick the compression off in the background so it overlaps with
+            # tearing down the model process below instead of running after it.
+            print('Compressing the output')
+            zip_job = zip_executor.submit(zipdir, args.compressed_file_path, args.out_dir)
     except Exception as e:
         if args.compressed_file_path is not None:
             # Compress the outputs
@@ -178,11 +269,10 @@ def run(args):
             print('Done, killing model process: {}'.format(model._model_process.pid))
             os.killpg(os.getpgid(model._model_process.pid), signal.SIGTERM)
 
-    
-    if args.compressed_file_path is not None:
-        # Compress the outputs
-        print('Compressing the output')
-        zipdir(args.compressed_file_path, args.out_dir)
+    if zip_job is not None:
+        # Make sure the archive is complete before returning.
+        zip_job.result()
+    zip_executor.shutdown()
 
 @ex.automain
 def command_line_entry(_run,_config, _seed):
@@ -19,6 +19,8 @@ import warnings
 import matplotlib.ticker as mtick
 import os
 
+from matplotlib.collections import LineCollection
+
 from copy import deepcopy as dc
 
 # Import SEIR module.
@@ -26,13 +28,15 @@ import seir as seir
 
 # Limit the number of simulations we plot.
 n_sims_to_plot = 100
-_sims_to_plot = np.random.randint(0, 1000, n_sims_to_plot)
+_RNG = np.random.default_rng(0)
+_sims_to_plot = _RNG.integers(0, 1000, n_sims_to_plot, dtype=np.int32)
+
+def _hex2rgb(_c):
+    return int(_c[1:3], 16), int(_c[3:5], 16), int(_c[5:7], 16)
 
-# `pip install colormap; pip install easydev`
-from colormap import hex2rgb
 muted_colours_list = ["#4878D0", "#D65F5F", "#EE854A", "#6ACC64", "#956CB4",
                       "#8C613C", "#DC7EC0", "#797979", "#D5BB67", "#82C6E2"]
-muted_colours_list = np.asarray([hex2rgb(_c) for _c in muted_colours_list]) / 256
+muted_colours_list = np.array([_hex2rgb(_c) for _c in muted_colours_list], dtype=np.float32) / 256
 muted_colours_dict = {'blue':   muted_colours_list[0],
                       'red':    muted_colours_list[1],
                       'orange': muted_colours_list[2],
@@ -52,18 +56,44 @@ fig_size_short = (4, 2)
 dpi=100
 
 
+# Numba is optional: when it is available the five compartment reductions are
+# fused into one parallel pass over the trajectory array, otherwise we fall
+# back to the (multi-pass) NumPy slice-and-sum.
+try:
+    from numba import njit, prange
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _compartment_statistics(_arr):
+        _n_t, _n_s = _arr.shape[0], _arr.shape[1]
+        _populace = np.empty((_n_t, _n_s), dtype=_arr.dtype)
+        _s_n = np.empty((_n_t, _n_s), dtype=_arr.dtype)
+        _e_n = np.empty((_n_t, _n_s), dtype=_arr.dtype)
+        _i_n = np.empty((_n_t, _n_s), dtype=_arr.dtype)
+        _r_n = np.empty((_n_t, _n_s), dtype=_arr.dtype)
+        for _t_i in prange(_n_t):
+            for _s_i in range(_n_s):
+                _row = _arr[_t_i, _s_i]
+                _s_n[_t_i, _s_i] = _row[0]
+                _e_n[_t_i, _s_i] = _row[1]
+                _i_n[_t_i, _s_i] = _row[2] + _row[3] + _row[4]
+                _r_n[_t_i, _s_i] = _row[5]
+                _populace[_t_i, _s_i] = _row[0] + _row[1] + _row[2] + _row[3] + _row[4] + _row[5]
+        return _populace, _s_n, _e_n, _i_n, _r_n
+except ImportError:
+    def _compartment_statistics(_arr):
+        _populace = _arr[:, :, :-1].sum(axis=2)
+        return _populace, _arr[:, :, 0], _arr[:, :, 1], _arr[:, :, 2:5].sum(axis=2), _arr[:, :, 5]
+
+
 def get_statistics(_results):
     """
     Work out the fractions of the population in each compartment..
     :param _results:
     :return:
     """
-    _populace = np.sum(_results[:, :, :-1].numpy(), axis=2)
-    _s_n = _results.numpy()[:, :, 0]
-    _e_n = _results.numpy()[:, :, 1]
-    _i_n = _results.numpy()[:, :, 2] + _results.numpy()[:, :, 3] + _results.numpy()[:, :, 4]
-    _r_n = _results.numpy()[:, :, 5]
-    return _populace, _s_n, _e_n, _i_n, _r_n
+    # Convert once; each .numpy() call on a CUDA tensor is a full device->host copy.
+    _results_np = np.ascontiguousarray(_results.detach().cpu().numpy())
+    return _compartment_statistics(_results_np)
 
 
 def get_alphas(_valid_simulations, _plot_valid=None):
@@ -83,10 +113,39 @@ def get_alphas(_valid_simulations, _plot_valid=None):
         _alpha_invalid = 2.0
         _alpha_valid = 2.0
 
-    _alphas = _alpha_invalid + _alpha_valid * _valid_simulations.numpy().astype(np.int)
+    # int8 validity flags and float32 alphas: Matplotlib works in float32
+    # internally, and this avoids the removed np.int alias.
+    _valid = _valid_simulations.numpy().astype(np.int8, copy=False)
+    _alphas = (_alpha_invalid + _alpha_valid * _valid).astype(np.float32)
     return _alphas
 
 
+def _plot_sim_lines(_axe, _x, _y, _sims, _colour, _alphas, _linestyle='-', _label=None, _zorder=None):
+    """
+    Draw one line per simulation as a single LineCollection, rather than one
+    `plot` artist per simulation (which dominates draw time for ~100 sims).
+    :param _axe:
+    :param _x:          (T, ) x values shared by all lines.
+    :param _y:          (T x N) series, one column per simulation.
+    :param _sims:       indices of the simulations to draw.
+    :param _colour:     RGB colour shared by all lines.
+    :param _alphas:     per-simulation alpha values (clipped to 1.0).
+    :return:
+    """
+    _colours = np.empty((len(_sims), 4), dtype=np.float32)
+    _colours[:, :3] = _colour
+    _colours[:, 3] = np.minimum(_alphas[_sims], 1.0)
+    # One fancy-index gather per series, then build all segments in one shot.
+    _y_sims = _y[:, _sims]
+    _segments = np.empty((len(_sims), len(_x), 2))
+    _segments[:, :, 0] = _x
+    _segments[:, :, 1] = _y_sims.T
+    _lc = LineCollection(_segments, colors=_colours, linestyles=_linestyle, label=_label)
+    if _zorder is not None:
+        _lc.set_zorder(_zorder)
+    _axe.add_collection(_lc)
+
+
 def make_trajectory_plot(_axe, _params, _results_visited, _results_noise, _valid_simulations, _t,
                          _plot_valid=False, _ylim=None, _shade=False):
     """
@@ -105,7 +164,7 @@ def make_trajectory_plot(_axe, _params, _results_visited, _results_noise, _valid
 
     if _results_visited is not None:
         _t_idx_current = len(_results_visited)
-        _s_idx_current = np.int(np.round(7.0/_params.dt))  # TODO - the number in here has to be equal to the planning horizon.
+        _s_idx_current = int(np.round(7.0/_params.dt))  # TODO - the number in here has to be equal to the planning horizon.
     else:
         _t_idx_current = 0
         _s_idx_current = 0
@@ -131,11 +190,13 @@ def make_trajectory_plot(_axe, _params, _results_visited, _results_noise, _valid
 
     _p_n, _s_n, _e_n, _i_n, _r_n = get_statistics(_results_noise)
     if not _shade:
-        [_axe.plot(_t[_t_idx_current - _s_idx_current:] - 1, _s_n[:, _i], c=mcd['green'],     linestyle=_ls, alpha=np.min((_alphas[_i], 1.0)), label='$S_t$') for _i in __sims_to_plot]  # np.int(np.round(__t / _params.dt))
-        [_axe.plot(_t[_t_idx_current - _s_idx_current:] - 1, _e_n[:, _i], c=mcd['blue'],      linestyle=_ls, alpha=np.min((_alphas[_i], 1.0)), label='$E_t$') for _i in __sims_to_plot]
-        [_axe.plot(_t[_t_idx_current - _s_idx_current:] - 1, _i_n[:, _i], c=mcd['red'],       linestyle=_ls, alpha=np.min((2.0*_alphas[_i], 1.0)), label='$I_t$', zorder=10000) for _i in __sims_to_plot]
-        [_axe.plot(_t[_t_idx_current - _s_idx_current:] - 1, _r_n[:, _i], c=mcd['purple'],    linestyle=_ls, alpha=np.min((_alphas[_i], 1.0)), label='$R_t$') for _i in __sims_to_plot]
-        [_axe.plot(_t[_t_idx_current - _s_idx_current:] - 1, _p_n[:, _i], 'k:', alpha=np.min((_alphas[_i], 1.0)), label='$N_t$') for _i in __sims_to_plot]
+        __sims = np.asarray(__sims_to_plot, dtype=np.intp)
+        _x = (_t[_t_idx_current - _s_idx_current:] - 1).numpy()
+        _plot_sim_lines(_axe, _x, _s_n, __sims, mcd['green'],  _alphas, _linestyle=_ls, _label='$S_t$')
+        _plot_sim_lines(_axe, _x, _e_n, __sims, mcd['blue'],   _alphas, _linestyle=_ls, _label='$E_t$')
+        _plot_sim_lines(_axe, _x, _i_n, __sims, mcd['red'],    2.0 * _alphas, _linestyle=_ls, _label='$I_t$', _zorder=10000)
+        _plot_sim_lines(_axe, _x, _r_n, __sims, mcd['purple'], _alphas, _linestyle=_ls, _label='$R_t$')
+        _plot_sim_lines(_axe, _x, _p_n, __sims, np.zeros(3),   _alphas, _linestyle=':', _label='$N_t$')
     else:
         _m = np.median(_p_n, axis=1)
         _uq = np.quantile(_p_n, 0.9, axis=1)
@@ -232,8 +293,13 @@ def make_parameter_plot(_axe, _new_parameters, _valid_simulations):
     bin_centers = 0.5 * (bin_lims[:-1] + bin_lims[1:])
     bin_widths = bin_lims[1:] - bin_lims[:-1]
 
-    counts1, _ = np.histogram(1 - _new_parameters.u[torch.logical_not(_valid_simulations)].numpy(), bins=bin_lims)
-    counts2, _ = np.histogram(1 - _new_parameters.u[_valid_simulations.type(torch.bool)].numpy(), bins=bin_lims)
+    # Bin once with digitize + bincount rather than running np.histogram
+    # (a binary search per element) over each masked subset.
+    _inv_u = 1 - _new_parameters.u.numpy()
+    _valid = _valid_simulations.numpy().astype(bool)
+    _bin_idx = np.clip(np.digitize(_inv_u, bin_lims) - 1, 0, num_bin - 1)
+    counts1 = np.bincount(_bin_idx[~_valid], minlength=num_bin)
+    counts2 = np.bincount(_bin_idx[_valid], minlength=num_bin)
 
     hist1b = counts1 / (np.sum(counts1) + np.sum(counts2))
     hist2b = counts2 / (np.sum(counts1) + np.sum(counts2))
@@ -256,8 +322,14 @@ def make_parameter_plot(_axe, _new_parameters, _valid_simulations):
 
 def make_policy_plot(_axe, _params, _alpha, _beta, _valid_simulations, _typical_u, _typical_alpha, _typical_beta):
     _u = _params.u
-    _color_list = [muted_colours_dict['red'], muted_colours_dict['green']]
-    [_axe.plot(_alpha, _beta[_i], c=_color_list[_valid_simulations[_i].type(torch.int)]) for _i in range(len(_valid_simulations))]
+    # One colour gather + one LineCollection instead of a plot call (and a
+    # tensor->int conversion) per simulation.
+    _color_list = np.stack((muted_colours_dict['red'], muted_colours_dict['green']))
+    _colours = _color_list[_valid_simulations.to(torch.int).cpu().numpy()]
+    _segments = np.empty((len(_beta), len(_alpha), 2))
+    _segments[:, :, 0] = _alpha
+    _segments[:, :, 1] = _beta
+    _axe.add_collection(LineCollection(_segments, colors=_colours))
     _axe.set_xlim(left=0.0, right=1.0)
     _axe.set_ylim(bottom=0.0, top=1.0)
     _axe.grid(True)
@@ -335,7 +407,7 @@ def nmc_plot(outer_samples, _threshold, _prepend='nmc_', _append=''):
     nmc_axe.plot((0, 1), (0.9, 0.9), 'k:')
 
     _c_l = np.asarray([muted_colours_dict['red'], muted_colours_dict['green']])
-    _c = _c_l[(np.asarray(outer_samples['p_valid']) > _threshold).astype(np.int)]
+    _c = _c_l[(np.asarray(outer_samples['p_valid']) > _threshold).astype(int)]
     plt.scatter((1-outer_samples['u']), np.asarray(outer_samples['p_valid']), c=_c)
 
     plt.grid(True)
@@ -361,7 +433,7 @@ def det_plot(results_deterministic, valid_simulations, params, t, _append='', _l
     # Store and overwrite the sims to plot.
     global _sims_to_plot
     _sims_to_plot_store = dc(_sims_to_plot)
-    _sims_to_plot = np.arange(np.alen(valid_simulations))
+    _sims_to_plot = np.arange(len(valid_simulations))
 
     try:
         os.mkdir('./pdf/1_deterministic_')
@@ -71,7 +71,7 @@ initial_population = 10000
 N_simulation = 100
 N_parameter_sweep = 150
 
-plotting._sims_to_plot = np.random.randint(0, N_simulation, plotting.n_sims_to_plot)
+plotting._sims_to_plot = plotting._RNG.integers(0, N_simulation, plotting.n_sims_to_plot, dtype=np.int32)
 
 # Automatically define other required variables.
 t = torch.linspace(0, T, int(T / dt) + 1)
@@ -178,7 +178,7 @@ if __name__ == '__main__':
         results_noise = seir.simulate_seir(initial_state, noised_parameters, dt, T, seir.sample_unknown_parameters)
         valid_simulations = valid_simulation(results_noise, noised_parameters)
 
-        plotting._sims_to_plot = np.arange(np.alen(valid_simulations))
+        plotting._sims_to_plot = np.arange(len(valid_simulations))
         plotting.do_family_of_plots(noised_parameters, results_noise, valid_simulations, t, _prepend='2_simulation_', _num='')
         plt.close('all')
 
@@ -370,7 +370,7 @@ if __name__ == '__main__':
         pool = proc.Pool(proc.cpu_count())
 
         # We don't want to re-plan at every step.  7 = replan every week.  # TODO must match value in plotting.
-        planning_step = np.int(np.round(7.0 / dt))
+        planning_step = int(np.round(7.0 / dt))
 
         # Counter for labelling images.
         img_frame = 0
@@ -405,7 +405,7 @@ if __name__ == '__main__':
 
             # If we are above t=200 sample random continuations to test the MPC.
             if _t > 200:
-                _n = np.random.randint(0, N_simulation - 1)
+                _n = plotting._RNG.integers(0, N_simulation - 1)
                 _visited_states = outer_samples['results_noise'][first_valid_simulation][1:(planning_step + 1), _n]
             else:
                 # Otherwise, sample an ``adversarial'' example to generate some baseline infection.
@@ -430,7 +430,7 @@ if __name__ == '__main__':
                 plotting.nmc_plot(outer_samples, threshold, _prepend='5_mpc_', _append='_{:05d}'.format(img_frame))
 
                 # Trajectory plot.
-                plotting._sims_to_plot = np.random.randint(0, N_parameter_sweep-1, 50)
+                plotting._sims_to_plot = plotting._RNG.integers(0, N_parameter_sweep-1, 50, dtype=np.int32)
                 controlled_params.u = torch.ones((N_simulation,)) * u_sweep[first_valid_simulation]
                 plotting.do_family_of_plots(controlled_params, outer_samples['results_noise'][first_valid_simulation],
                                             torch.ones((N_simulation,)), t, _visited_states=visited_states,